@@ -152,6 +152,7 @@ CREATE TABLE IF NOT EXISTS trope_finding
     verifier_flag       TEXT,
     calibration_version TEXT,
     threshold_used      REAL,
+    reviewed            INTEGER, -- 1 once any trope_finding_human row exists (triggers below)
 
     FOREIGN KEY (work_id) REFERENCES work (id) ON DELETE CASCADE,
     FOREIGN KEY (scene_id) REFERENCES scene (id) ON DELETE SET NULL,
@@ -165,6 +166,11 @@ CREATE INDEX IF NOT EXISTS idx_finding_work ON trope_finding (work_id);
 CREATE INDEX IF NOT EXISTS idx_tf_trope_created ON trope_finding (trope_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_tf_verifier_flag ON trope_finding (verifier_flag);
 CREATE INDEX IF NOT EXISTS idx_tf_calib ON trope_finding (calibration_version);
+CREATE INDEX IF NOT EXISTS idx_tf_scene_conf ON trope_finding (scene_id, confidence);
+-- review queue 'uncertain' order (keys match queue_cli.order_sql); only unreviewed rows are indexed
+CREATE INDEX IF NOT EXISTS idx_tf_uncert
+    ON trope_finding (ABS(COALESCE(confidence, 0.5) - 0.5), COALESCE(created_at, '0000') DESC)
+    WHERE reviewed IS NULL;
 
 
 -- Relations & examples (optional)
@@ -278,13 +284,36 @@ CREATE TABLE IF NOT EXISTS trope_finding_human
 );
 CREATE INDEX IF NOT EXISTS idx_tfh_finding ON trope_finding_human (finding_id);
 
+CREATE INDEX IF NOT EXISTS idx_tfh_fid_cat ON trope_finding_human (finding_id, created_at DESC);
+
+-- latest decision per finding (index seek on idx_tfh_fid_cat); rowid breaks created_at ties
 CREATE VIEW IF NOT EXISTS v_latest_human AS
 SELECT h.*
 FROM trope_finding_human h
-         JOIN (SELECT finding_id, MAX(created_at) AS mx
-               FROM trope_finding_human
-               GROUP BY finding_id) last
-              ON last.finding_id = h.finding_id AND last.mx = h.created_at;
+WHERE h.rowid = (SELECT rowid
+                 FROM trope_finding_human
+                 WHERE finding_id = h.finding_id
+                 ORDER BY created_at DESC, rowid DESC
+                 LIMIT 1);
+
+-- keep trope_finding.reviewed in sync with trope_finding_human
+CREATE TRIGGER IF NOT EXISTS tfh_mark_reviewed
+    AFTER INSERT
+    ON trope_finding_human
+BEGIN
+    UPDATE trope_finding SET reviewed = 1 WHERE id = new.finding_id AND reviewed IS NULL;
+END;
+
+CREATE TRIGGER IF NOT EXISTS tfh_unmark_reviewed
+    AFTER DELETE
+    ON trope_finding_human
+BEGIN
+    UPDATE trope_finding
+    SET reviewed = CASE
+                       WHEN EXISTS(SELECT 1 FROM trope_finding_human WHERE finding_id = old.finding_id) THEN 1
+                       ELSE NULL END
+    WHERE id = old.finding_id;
+END;
 
 -- ====================================================
 -- FTS triggers for chunk_fts
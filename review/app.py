@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import os, sqlite3, uuid
+import hashlib, json, os, secrets, sqlite3
+from collections import namedtuple
+from functools import lru_cache
 from pathlib import Path
-from flask import Flask, g, render_template, request, jsonify, abort
+from flask import Flask, g, render_template, request, jsonify, abort, Response
 from flask import url_for
 
 
@@ -11,12 +13,43 @@ ROOT = Path(__file__).resolve().parent
 DEFAULT_DB = (ROOT.parent / "ingester" / "tropes.db").as_posix()
 DB_PATH = os.getenv("TROPES_DB", DEFAULT_DB)
 
-app = Flask(__name__, static_folder="static", template_folder="templates")
+class ReviewFlask(Flask):
+    def get_send_file_max_age(self, filename: str | None) -> int | None:
+        # checked per request: debug is only known once run()/FLASK_DEBUG applies,
+        # so dev always revalidates while prod uses SEND_FILE_MAX_AGE_DEFAULT
+        return 0 if self.debug else super().get_send_file_max_age(filename)
+
+
+app = ReviewFlask(__name__, static_folder="static", template_folder="templates")
 app.config.update(
     SECRET_KEY=os.getenv("REVIEW_SECRET", "dev"),
-    SEND_FILE_MAX_AGE_DEFAULT=0,  # dev: always serve fresh static files
+    # cache for a day outside debug (URLs are content-hashed)
+    SEND_FILE_MAX_AGE_DEFAULT=86400,
+    # behind nginx/Apache, let the proxy stream static files (X-Sendfile)
+    USE_X_SENDFILE=os.getenv("REVIEW_X_SENDFILE") == "1",
 )
 
+
+def _static_hashes() -> dict:
+    root = ROOT / "static"
+    return {
+        p.relative_to(root).as_posix(): hashlib.blake2b(p.read_bytes(), digest_size=8).hexdigest()
+        for p in root.rglob("*") if p.is_file()
+    }
+
+
+STATIC_HASH = _static_hashes()
+
+
+@app.url_defaults
+def _static_cache_bust(endpoint: str, values: dict) -> None:
+    # url_for('static', filename=...) gets ?v=<content hash> unless one is given;
+    # skipped in debug, where the startup hashes go stale as files are edited
+    if endpoint == "static" and "v" not in values and not app.debug:
+        h = STATIC_HASH.get(values.get("filename"))
+        if h:
+            values["v"] = h
+
 # ---- Display-time quote fixes (doesn't affect DB offsets) ----------------
 DISPLAY_CHAR_MAP = str.maketrans({
     # Some MacRoman-encoded punctuation we observed in text dumps
@@ -25,17 +58,57 @@ DISPLAY_CHAR_MAP = str.maketrans({
 
 
 def display_fix_quotes(s: str) -> str:
-    return s.translate(DISPLAY_CHAR_MAP)
+    # every mapped glyph is non-ASCII, so pure-ASCII text needs no translate copy
+    return s if (not s or s.isascii()) else s.translate(DISPLAY_CHAR_MAP)
+
+
+def _scene_bounds(row) -> tuple[int, int]:
+    # INTEGER columns already arrive as int; only coerce odd legacy values
+    s0, s1 = row.char_start, row.char_end
+    if type(s0) is not int or type(s1) is not int:
+        s0, s1 = int(s0), int(s1)
+    return s0, s1
 
 
 # --- DB helpers -----------------------------------------------------------
+# Read-mostly review workload: WAL so reviewer writes don't block dashboard
+# reads, mmap so page reads skip read() syscalls, and a 64 MiB page cache.
+# (page_size is fixed per file; see `gmake db-tune` to rebuild at 16 KiB.)
+CONN_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA mmap_size=1073741824;
+PRAGMA cache_size=-65536;
+PRAGMA temp_store=MEMORY;
+PRAGMA wal_autocheckpoint=1000;
+"""
+
+
 def get_db() -> sqlite3.Connection:
     if "db" not in g:
         g.db = sqlite3.connect(DB_PATH)
         g.db.row_factory = sqlite3.Row
+        g.db.executescript(CONN_PRAGMAS)
     return g.db
 
 
+@lru_cache(maxsize=64)
+def _row_type(fields: tuple) -> type:
+    return namedtuple("Row", fields, rename=True)
+
+
+def fetch_nt(db: sqlite3.Connection, sql: str, args=()) -> list:
+    """
+    Run a hot-path query and return namedtuple rows (attribute access is a
+    slot read rather than sqlite3.Row's by-name column scan).
+    """
+    cur = db.cursor()
+    cur.row_factory = None
+    cur.execute(sql, args)
+    R = _row_type(tuple(d[0] for d in cur.description))
+    return [R._make(r) for r in cur]
+
+
 @app.teardown_appcontext
 def close_db(_exc):
     db = g.pop("db", None)
@@ -43,10 +116,29 @@ def close_db(_exc):
         db.close()
 
 
+# Trope catalog rarely changes during a review session; cache the sorted
+# (id, name) list per process. Cleared by /api/new_finding and /admin/refresh.
+_TROPE_CACHE = {"v": None}
+
+
+def get_tropes(db: sqlite3.Connection) -> list:
+    if _TROPE_CACHE["v"] is None:
+        _TROPE_CACHE["v"] = fetch_nt(db, "SELECT id, name FROM trope ORDER BY name COLLATE NOCASE")
+    return _TROPE_CACHE["v"]
+
+
+def invalidate_tropes() -> None:
+    _TROPE_CACHE["v"] = None
+
+
 def ensure_review_schema(conn: sqlite3.Connection) -> None:
     """
     Creates the human review table + view if missing.
     """
+    # Older DBs carry a tie-prone form of v_latest_human; swap in the current one.
+    old = conn.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name='v_latest_human'").fetchone()
+    if old and "rowid DESC" not in old[0]:
+        conn.execute("DROP VIEW v_latest_human")
     conn.executescript("""
     PRAGMA foreign_keys=ON;
 
@@ -63,16 +155,19 @@ def ensure_review_schema(conn: sqlite3.Connection) -> None:
       FOREIGN KEY(finding_id) REFERENCES trope_finding(id) ON DELETE CASCADE
     );
     CREATE INDEX IF NOT EXISTS idx_tfh_finding ON trope_finding_human(finding_id);
+    CREATE INDEX IF NOT EXISTS idx_tfh_fid_cat ON trope_finding_human(finding_id, created_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_tf_scene_conf ON trope_finding(scene_id, confidence);
 
+    -- latest decision per finding (index seek on idx_tfh_fid_cat); rowid breaks
+    -- created_at ties, e.g. edit + accept written in the same millisecond
     CREATE VIEW IF NOT EXISTS v_latest_human AS
     SELECT h.*
     FROM trope_finding_human h
-    JOIN (
-      SELECT finding_id, MAX(created_at) AS mx
-      FROM trope_finding_human
-      GROUP BY finding_id
-    ) last
-      ON last.finding_id = h.finding_id AND last.mx = h.created_at;
+    WHERE h.rowid = (SELECT rowid
+                     FROM trope_finding_human
+                     WHERE finding_id = h.finding_id
+                     ORDER BY created_at DESC, rowid DESC
+                     LIMIT 1);
     """)
     conn.commit()
 
@@ -92,7 +187,7 @@ def index():
                                 LEFT JOIN (SELECT work_id, COUNT(*) AS cnt
                                            FROM trope_finding
                                            GROUP BY work_id) tf ON tf.work_id = w.id
-                                LEFT JOIN (SELECT f.work_id, COUNT(DISTINCT h.finding_id) AS cnt
+                                LEFT JOIN (SELECT f.work_id, COUNT(*) AS cnt
                                            FROM trope_finding f
                                                     JOIN v_latest_human h ON h.finding_id = f.id
                                            GROUP BY f.work_id) hc ON hc.work_id = w.id
@@ -138,7 +233,7 @@ def scene(scene_id: str):
     db = get_db()
     ensure_review_schema(db)  # make sure v_latest_human exists on deep links
 
-    row = db.execute("""
+    rows = fetch_nt(db, """
                      SELECT s.id,
                             s.idx,
                             s.work_id,
@@ -150,15 +245,16 @@ def scene(scene_id: str):
                      FROM scene s
                               JOIN work w ON w.id = s.work_id
                      WHERE s.id = ?
-                     """, (scene_id,)).fetchone()
-    if not row:
+                     """, (scene_id,))
+    if not rows:
         abort(404)
+    row = rows[0]
 
-    s0, s1 = int(row["char_start"]), int(row["char_end"])
-    full = row["norm_text"] or ""
+    s0, s1 = _scene_bounds(row)
+    full = row.norm_text or ""
     scene_text = display_fix_quotes(full[s0:s1])
 
-    findings = db.execute("""
+    findings = fetch_nt(db, """
                           SELECT f.id,
                                  f.trope_id,
                                  t.name           AS trope,
@@ -173,37 +269,43 @@ def scene(scene_id: str):
                               LEFT JOIN v_latest_human h ON h.finding_id = f.id
                           WHERE f.scene_id = ?
                           ORDER BY f.evidence_start, f.evidence_end
-                          """, (scene_id,)).fetchall()
-
-    spans = []
-    for r in findings:
-        try:
-            spans.append({
-                "id": r["id"],
-                "start": int(r["start"]),
-                "end": int(r["end"]),
-                "trope": r["trope"],
-                "confidence": float(r["confidence"] or 0.0),
-            })
-        except Exception:
-            continue
-
-    tropes = db.execute(
-        "SELECT id, name FROM trope ORDER BY name COLLATE NOCASE"
-    ).fetchall()
+                          """, (scene_id,))
+
+    # Serialize the highlighter payload in SQLite (JSON1); one string crosses
+    # into Python and goes straight into the template.
+    spans_json = db.execute("""
+                            SELECT COALESCE(json_group_array(json_object(
+                                    'id', id, 'start', start, 'end', "end",
+                                    'trope', trope, 'confidence', confidence)), '[]')
+                            FROM (SELECT f.id,
+                                         f.evidence_start             AS start,
+                                         f.evidence_end               AS "end",
+                                         t.name                       AS trope,
+                                         COALESCE(f.confidence, 0.0)  AS confidence
+                                  FROM trope_finding f
+                                           JOIN trope t ON t.id = f.trope_id
+                                  WHERE f.scene_id = ?
+                                    AND f.evidence_start IS NOT NULL
+                                    AND f.evidence_end IS NOT NULL
+                                  ORDER BY f.evidence_start, f.evidence_end)
+                            """, (scene_id,)).fetchone()[0]
+    # same <script>-safe escaping Jinja's tojson applies
+    spans_json = spans_json.replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026")
+
+    tropes = get_tropes(db)
 
     return render_template(
         "scene.html",
-        work_id=row["work_id"],
-        title=row["title"],
-        author=row["author"],
-        scene_id=row["id"],
-        scene_idx=row["idx"],
+        work_id=row.work_id,
+        title=row.title,
+        author=row.author,
+        scene_id=row.id,
+        scene_idx=row.idx,
         scene_text=scene_text,
         offset=s0,
         findings=findings,
         tropes=tropes,
-        spans=spans,
+        spans_json=spans_json,
     )
 
 
@@ -257,9 +359,9 @@ def queue():
     else:
         order_sql = "ABS(COALESCE(f.confidence,0.5) - 0.5) ASC, COALESCE(f.created_at, '0000') DESC"
 
-    row = db.execute(f"""
+    rows = fetch_nt(db, f"""
       SELECT
-        f.id, f.work_id, f.scene_id, f.trope_id, f.confidence,
+        f.id, f.work_id, f.scene_id, f.trope_id, COALESCE(f.confidence, 0.0) AS confidence,
         f.evidence_start AS start, f.evidence_end AS end, f.rationale,
         t.name AS trope,
         s.idx AS scene_idx, s.char_start, s.char_end,
@@ -272,7 +374,8 @@ def queue():
       WHERE {where_sql}
       ORDER BY {order_sql}
       LIMIT 1
-    """, args).fetchone()
+    """, args)
+    row = rows[0] if rows else None
 
     if not row:
         # Render an empty-queue page with quick links back
@@ -281,13 +384,13 @@ def queue():
             "min_conf": min_conf, "max_conf": max_conf
         })
 
-    s0, s1 = int(row["char_start"]), int(row["char_end"])
-    scene_text = display_fix_quotes((row["norm_text"] or "")[s0:s1])
+    s0, s1 = _scene_bounds(row)
+    scene_text = display_fix_quotes((row.norm_text or "")[s0:s1])
 
     # one-card list so existing review.js highlighter can operate
     spans = [{
-        "id": row["id"], "start": int(row["start"]), "end": int(row["end"]),
-        "trope": row["trope"], "confidence": float(row["confidence"] or 0.0),
+        "id": row.id, "start": row.start, "end": row.end,
+        "trope": row.trope, "confidence": row.confidence,
     }]
 
     return render_template(
@@ -304,7 +407,7 @@ def queue():
 
 # --- API: accept / reject / edit / new -----------------------------------
 def _uuid() -> str:
-    return str(uuid.uuid4())
+    return secrets.token_hex(16)
 
 
 @app.post("/api/decision")
@@ -340,41 +443,42 @@ def api_edit_span():
     db = get_db()
     ensure_review_schema(db)
 
-    # Look up text length via the finding’s work_id
-    row = db.execute("""
-                     SELECT f.work_id, COALESCE(length(w.norm_text), 0) AS n
-                     FROM trope_finding f
-                              JOIN work w ON w.id = f.work_id
-                     WHERE f.id = ?
-                     """, (fid,)).fetchone()
-    if not row:
-        return jsonify({"ok": False, "error": "finding not found"}), 404
+    # Clamp to the work's text length inside the UPDATE itself (no preflight
+    # SELECT); history row + canonical update share one IMMEDIATE transaction.
+    with db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute("""
+                         WITH lim(n) AS (SELECT COALESCE(length(w.norm_text), 0)
+                                         FROM trope_finding f
+                                                  JOIN work w ON w.id = f.work_id
+                                         WHERE f.id = :fid)
+                         UPDATE trope_finding
+                         SET evidence_start = MIN(MAX(:start, 0), (SELECT n FROM lim)),
+                             evidence_end   = MIN(MAX(:end, 0), (SELECT n FROM lim)),
+                             trope_id       = COALESCE(:trope_id, trope_id)
+                         WHERE id = :fid
+                           AND MIN(MAX(:end, 0), (SELECT n FROM lim)) > MIN(MAX(:start, 0), (SELECT n FROM lim))
+                         RETURNING evidence_start, evidence_end
+                         """, {"fid": fid, "start": start, "end": end, "trope_id": trope_id}).fetchone()
+        if row:
+            # History row (non-destructive audit of the update above)
+            db.execute("""
+                       INSERT INTO trope_finding_human
+                       (id, finding_id, decision, corrected_start, corrected_end, corrected_trope_id, note, reviewer)
+                       VALUES (?, ?, 'edit', ?, ?, ?, ?, ?)
+                       """, (_uuid(), fid, row["evidence_start"], row["evidence_end"], trope_id, note, reviewer))
 
-    N = int(row["n"])
-    start = max(0, min(start, N))
-    end = max(0, min(end, N))
-    if end <= start:
+    if not row:
+        # no text length to clamp against (missing finding or work) is a 404;
+        # otherwise the clamped span was empty
+        if not db.execute("""
+                          SELECT 1
+                          FROM trope_finding f
+                                   JOIN work w ON w.id = f.work_id
+                          WHERE f.id = ?
+                          """, (fid,)).fetchone():
+            return jsonify({"ok": False, "error": "finding or work not found"}), 404
         return jsonify({"ok": False, "error": "end must be > start"}), 400
-
-    # History row
-    db.execute("""
-               INSERT INTO trope_finding_human
-               (id, finding_id, decision, corrected_start, corrected_end, corrected_trope_id, note, reviewer)
-               VALUES (?, ?, 'edit', ?, ?, ?, ?, ?)
-               """, (_uuid(), fid, start, end, trope_id, note, reviewer))
-
-    # Apply to main finding (non-destructive; history above)
-    if trope_id:
-        db.execute(
-            "UPDATE trope_finding SET evidence_start=?, evidence_end=?, trope_id=? WHERE id=?",
-            (start, end, trope_id, fid)
-        )
-    else:
-        db.execute(
-            "UPDATE trope_finding SET evidence_start=?, evidence_end=? WHERE id=?",
-            (start, end, fid)
-        )
-    db.commit()
     return jsonify({"ok": True})
 
 
@@ -408,24 +512,33 @@ def api_new_finding():
         db.commit()
     except sqlite3.IntegrityError:
         return jsonify({"ok": False, "error": "duplicate finding"}), 409
+    finally:
+        invalidate_tropes()
 
     return jsonify({"ok": True, "id": fid})
 
 
+@app.post("/admin/refresh")
+def admin_refresh():
+    """Drop per-process caches (e.g. after reloading the trope catalog)."""
+    invalidate_tropes()
+    return jsonify({"ok": True})
+
+
 # --- Diagnostics ----------------------------------------------------------
 @app.get("/__diag")
 def diag():
     db = get_db()
-    c = db.cursor()
-    w = c.execute("SELECT COUNT(*) FROM work").fetchone()[0]
-    s = c.execute("SELECT COUNT(*) FROM scene").fetchone()[0]
-    f = c.execute("SELECT COUNT(*) FROM trope_finding").fetchone()[0]
-    bad = c.execute("""
-                    SELECT COUNT(*)
-                    FROM trope_finding f
-                             JOIN scene s ON s.id = f.scene_id
-                    WHERE NOT (f.evidence_start >= s.char_start AND f.evidence_end <= s.char_end)
-                    """).fetchone()[0]
+    # one prepared statement for all four counts
+    w, s, f, bad = db.execute("""
+                              SELECT (SELECT COUNT(*) FROM work),
+                                     (SELECT COUNT(*) FROM scene),
+                                     (SELECT COUNT(*) FROM trope_finding),
+                                     (SELECT COUNT(*)
+                                      FROM trope_finding f
+                                               JOIN scene s ON s.id = f.scene_id
+                                      WHERE NOT (f.evidence_start >= s.char_start AND f.evidence_end <= s.char_end))
+                              """).fetchone()
     return jsonify({"ok": True, "db": DB_PATH, "works": w, "scenes": s, "findings": f, "findings_outside_scene": bad})
 
 
@@ -457,9 +570,13 @@ def scene_plain(scene_id: str):
     return html
 
 
+# Static payload: probes hit this often, so skip per-request JSON encoding.
+_HEALTHZ_BODY = json.dumps({"ok": True, "db": DB_PATH}).encode("utf-8")
+
+
 @app.get("/healthz")
 def healthz():
-    return jsonify({"ok": True, "db": DB_PATH})
+    return Response(_HEALTHZ_BODY, mimetype="application/json")
 
 
 if __name__ == "__main__":
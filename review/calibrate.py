@@ -13,64 +13,91 @@ from __future__ import annotations
 import argparse, json, os, sqlite3
 from pathlib import Path
 import math
-import matplotlib.pyplot as plt  # stdlib-friendly; no seaborn
-
-
-def fetch(db: str):
-    con = sqlite3.connect(db);
-    con.row_factory = sqlite3.Row
-    rows = con.execute("""
-                       SELECT f.id, f.confidence, h.decision
-                       FROM trope_finding f
-                                JOIN (SELECT h1.finding_id, h1.decision
-                                      FROM trope_finding_human h1
-                                               JOIN (SELECT finding_id, MAX(created_at) mx
-                                                     FROM trope_finding_human
-                                                     GROUP BY finding_id) last
-                                                    ON last.finding_id = h1.finding_id AND last.mx = h1.created_at) h
-                                     ON h.finding_id = f.id
-                       WHERE h.decision IN ('accept', 'reject')
-                         AND f.confidence IS NOT NULL
-                       """).fetchall()
+import numpy as np
+
+
+# reviewed findings with a confidence: one row per finding, accepted = 1/0
+LABELED_SQL = """
+              SELECT f.confidence, (h.decision = 'accept') AS accepted
+              FROM trope_finding f
+                       JOIN trope_finding_human h
+                            ON h.finding_id = f.id
+                                AND h.rowid = (SELECT rowid
+                                               FROM trope_finding_human
+                                               WHERE finding_id = f.id
+                                               ORDER BY created_at DESC, rowid DESC
+                                               LIMIT 1)
+              WHERE h.decision IN ('accept', 'reject')
+                AND f.confidence IS NOT NULL
+              """
+
+
+def fetch(db: str, bins: int = 10):
+    """
+    Aggregate server-side so only small summaries cross into Python:
+      - n:       number of reviewed findings
+      - buckets: (bucket, n, accepted) per confidence bin
+      - sweep:   (confidence, tp_cum, fp_cum) per distinct confidence, descending
+    """
+    con = sqlite3.connect(db)
+    # run the latest-decision join once: one row per distinct confidence,
+    # which both the bucket and sweep queries below read
+    con.execute(f"""
+                CREATE TEMP TABLE labeled AS
+                SELECT confidence AS c, COUNT(*) AS n, SUM(accepted) AS pos
+                FROM ({LABELED_SQL})
+                GROUP BY confidence
+                """)
+    buckets = con.execute("""
+                          SELECT MIN(CAST(MAX(0.0, MIN(1.0, c)) * :bins AS INTEGER), :bins - 1) AS bucket,
+                                 SUM(n)                                                   AS n,
+                                 SUM(pos)                                                 AS acc
+                          FROM temp.labeled
+                          GROUP BY bucket
+                          ORDER BY bucket
+                          """, {"bins": bins}).fetchall()
+    n = sum(cnt for _, cnt, _ in buckets)
+    sweep = con.execute("""
+                        SELECT c,
+                               SUM(pos) OVER w     AS tp_cum,
+                               SUM(n - pos) OVER w AS fp_cum
+                        FROM temp.labeled
+                        WINDOW w AS (ORDER BY c DESC ROWS UNBOUNDED PRECEDING)
+                        ORDER BY c DESC
+                        """).fetchall()
     con.close()
-    return rows
-
-
-def reliability(rows, bins=10):
-    # bin by confidence into [0,1]
-    buckets = [[] for _ in range(bins)]
-    for r in rows:
-        c = max(0.0, min(1.0, float(r["confidence"])))
-        b = min(bins - 1, int(c * bins))
-        buckets[b].append(1 if r["decision"] == "accept" else 0)
-    xs, ys, ns = [], [], []
-    for i, b in enumerate(buckets):
-        if not b: continue
-        xs.append((i + 0.5) / bins)
-        ys.append(sum(b) / len(b))
-        ns.append(len(b))
-    return xs, ys, ns
-
-
-def precision_recall(rows, threshold):
-    preds = [(float(r["confidence"]) >= threshold) for r in rows]
-    labels = [1 if r["decision"] == "accept" else 0 for r in rows]
-    tp = sum(1 for p, l in zip(preds, labels) if p and l)
-    fp = sum(1 for p, l in zip(preds, labels) if p and not l)
-    fn = sum(1 for p, l in zip(preds, labels) if (not p) and l)
-    prec = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-    rec = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-    f1 = 2 * prec * rec / (prec + rec) if (prec + rec) > 0 else 0.0
-    return prec, rec, f1, tp, fp, fn
-
-
-def pick_threshold(rows):
-    best = (0.0, 0.0, 0.0, 0.0)  # f1, thr, prec, rec
-    for k in range(0, 101):
-        thr = k / 100.0
-        prec, rec, f1, *_ = precision_recall(rows, thr)
-        if f1 > best[0]: best = (f1, thr, prec, rec)
-    return {"threshold": best[1], "f1": best[0], "precision": best[2], "recall": best[3]}
+    return n, buckets, np.array(sweep, dtype=np.float64).reshape(-1, 3)
+
+
+def reliability(buckets, bins=10):
+    # buckets: (bin index, count, accepted) rows from fetch(); empty bins are absent.
+    # bincount scatters them onto a dense [0, bins) grid, then empty bins are masked out.
+    rows = np.array(buckets, dtype=np.float64).reshape(-1, 3)
+    b = rows[:, 0].astype(np.intp)
+    n = np.bincount(b, weights=rows[:, 1], minlength=bins)
+    acc = np.bincount(b, weights=rows[:, 2], minlength=bins)
+    keep = n > 0
+    xs = (np.arange(bins) + 0.5) / bins
+    ys = acc / np.maximum(n, 1)
+    return xs[keep].tolist(), ys[keep].tolist(), n[keep].astype(np.int64).tolist()
+
+
+def pick_threshold(sweep):
+    """
+    sweep: (confidence, cumulative TP, cumulative FP) per distinct confidence,
+    highest first (>= t is positive). Evaluate F1 at every cut and argmax;
+    ties go to the smallest threshold, as in learn_thresholds.best_threshold.
+    """
+    if sweep.size == 0 or sweep[-1, 1] == 0:
+        return {"threshold": 0.0, "f1": 0.0, "precision": 0.0, "recall": 0.0}
+    c, tp, fp = sweep.T
+    fn = tp[-1] - tp
+    prec = tp / (tp + fp)
+    rec = tp / (tp + fn)
+    f1 = 2 * prec * rec / np.maximum(prec + rec, 1e-12)
+    # thresholds run high→low; argmax on the reversed array = smallest t on tie
+    i = len(f1) - 1 - int(np.argmax(f1[::-1]))
+    return {"threshold": float(c[i]), "f1": float(f1[i]), "precision": float(prec[i]), "recall": float(rec[i])}
 
 
 def main():
@@ -79,13 +106,20 @@ def main():
     ap.add_argument("--out-dir", default="ingester/out")
     args = ap.parse_args()
 
-    rows = fetch(args.db)
+    n, buckets, sweep = fetch(args.db)
     Path(args.out_dir).mkdir(parents=True, exist_ok=True)
-    if not rows:
+    if n == 0:
         print("[calib] no reviewed findings; review a few first")
         return
 
-    xs, ys, ns = reliability(rows)
+    # deferred: matplotlib is only needed once there is something to plot;
+    # headless Agg backend skips GUI backend probing
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt  # stdlib-friendly; no seaborn
+
+    xs, ys, ns = reliability(buckets)
     # Plot reliability
     plt.figure()
     plt.plot(xs, ys, marker='o', label='empirical')
@@ -96,11 +130,12 @@ def main():
     plt.legend()
     png = Path(args.out_dir) / "calibration.png"
     plt.savefig(png, bbox_inches='tight')
+    plt.close('all')
     print(f"[calib] wrote {png.resolve()}")
 
-    picked = pick_threshold(rows)
+    picked = pick_threshold(sweep)
     summary = {
-        "n_reviewed": len(rows),
+        "n_reviewed": n,
         "recommended_threshold": picked["threshold"],
         "max_f1": picked["f1"],
         "precision_at_thr": picked["precision"],
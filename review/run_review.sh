@@ -6,7 +6,7 @@ export FLASK_DEBUG=1
 export FLASK_ENV=development
 
 # install Flask (in your venv)
-pip install flask matplotlib
+pip install flask matplotlib numpy
 
 # start the review UI (dev server on http://127.0.0.1:5050)
 python app.py
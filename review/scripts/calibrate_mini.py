@@ -1,16 +1,55 @@
 # scripts/calibrate_mini.py
 import argparse, sqlite3, random, math
+from array import array
 from collections import defaultdict
+import numpy as np
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # scipy optional; greedy_match below is the fallback
+    linear_sum_assignment = None
 
-def iou(a,b):
-    # a,b = (start,end)
-    inter = max(0, min(a[1],b[1]) - max(a[0],b[0]))
-    union = max(a[1]-a[0],0) + max(b[1]-b[0],0) - inter
-    return 0.0 if union<=0 else inter/union
+def iou_matrix(ps, gs):
+    # ps (N,2), gs (M,2) = [start,end) rows → (N,M) IoU via broadcasting
+    inter = np.maximum(0, np.minimum(ps[:,None,1], gs[None,:,1]) - np.maximum(ps[:,None,0], gs[None,:,0]))
+    union = np.maximum(ps[:,1]-ps[:,0],0)[:,None] + np.maximum(gs[:,1]-gs[:,0],0)[None,:] - inter
+    return np.divide(inter, union, out=np.zeros(inter.shape), where=union>0)
 
-def fetch(conn, sql, args=()):
-    cur = conn.execute(sql, args); cols=[c[0] for c in cur.description]
-    return [dict(zip(cols,row)) for row in cur.fetchall()]
+def greedy_match(iou_mat, min_iou):
+    # repeatedly take the best remaining pair, then retire its row and column
+    m = iou_mat.copy(); pairs=[]
+    while m.size:
+        i, j = np.unravel_index(np.argmax(m), m.shape)
+        if m[i,j] <= 0 or m[i,j] < min_iou: break
+        pairs.append((int(i), int(j)))
+        m[i,:] = -1; m[:,j] = -1
+    return pairs
+
+def match_spans(iou_mat, min_iou):
+    """Optimal (Hungarian) pred↔gt assignment; keep pairs with IoU > 0 and ≥ min_iou.
+    Sub-threshold IoUs are zeroed before solving so they can't pull the
+    assignment away from pairs that would count. Returns (pred_idx, gt_idx) int arrays."""
+    if linear_sum_assignment is None:
+        pairs = np.array(greedy_match(iou_mat, min_iou), dtype=np.intp).reshape(-1,2)
+        return pairs[:,0], pairs[:,1]
+    ri, ci = linear_sum_assignment(-np.where(iou_mat >= min_iou, iou_mat, 0))
+    v = iou_mat[ri,ci]
+    keep = (v > 0) & (v >= min_iou)
+    return ri[keep], ci[keep]
+
+def load_spans(conn, sql, args=(), vocab=None):
+    # (scene_id, trope_id, s, e) rows streamed once and bucketed per scene into
+    # SoA buffers: (int32 trope codes, (N,2) int64 spans); codes come from the
+    # shared vocab (trope_id → int) so per-trope counts can be plain arrays.
+    # s/e must be non-NULL: the SQL filters out findings without a span
+    if vocab is None: vocab = {}
+    by_scene = defaultdict(lambda: (array('i'), array('q')))
+    for sid, tid, s, e in conn.execute(sql, args):
+        codes, se = by_scene[sid]
+        codes.append(vocab.setdefault(tid, len(vocab))); se.append(s); se.append(e)
+    return {sid: (np.frombuffer(codes, dtype=np.int32), np.frombuffer(se, dtype=np.int64).reshape(-1,2))
+            for sid, (codes, se) in by_scene.items()}
+
+NO_SPANS = (np.zeros(0, dtype=np.int32), np.zeros((0,2), dtype=np.int64))
 
 def main():
     ap = argparse.ArgumentParser()
@@ -21,60 +60,70 @@ def main():
     ap.add_argument('--iou', type=float, default=0.3)
     args = ap.parse_args()
 
-    DB = sqlite3.connect(args.db); DB.row_factory = sqlite3.Row
+    DB = sqlite3.connect(args.db)
 
     if args.scene_ids:
         scene_ids = [s.strip() for s in args.scene_ids.split(',') if s.strip()]
     else:
         # choose k recent scenes that have at least one finding
-        rows = fetch(DB, """
+        pool = [r[0] for r in DB.execute("""
           SELECT DISTINCT s.id
           FROM scene s JOIN trope_finding f ON f.scene_id = s.id
           ORDER BY s.id DESC
-        """)
-        pool = [r['id'] for r in rows]
+        """)]
         scene_ids = random.sample(pool, min(args.k, len(pool)))
 
+    # chosen scenes go into a temp table so both span queries run once for
+    # the whole sample instead of once per scene
+    DB.execute("CREATE TEMP TABLE scene_pick(id TEXT PRIMARY KEY)")
+    DB.executemany("INSERT OR IGNORE INTO temp.scene_pick(id) VALUES (?)", [(sid,) for sid in scene_ids])
+
+    vocab = {}
+    # predictions at threshold τ
+    preds = load_spans(DB, """
+      SELECT f.scene_id, f.trope_id, f.evidence_start AS s, f.evidence_end AS e
+      FROM trope_finding f
+      JOIN temp.scene_pick sp ON sp.id = f.scene_id
+      WHERE f.confidence >= ?
+        AND f.evidence_start IS NOT NULL AND f.evidence_end IS NOT NULL
+    """, (args.threshold,), vocab)
+
+    # ground truth = accepted latest human decisions (edits allowed)
+    gts = load_spans(DB, """
+      SELECT f.scene_id,
+             COALESCE(h.corrected_trope_id, f.trope_id) AS trope_id,
+             COALESCE(h.corrected_start, f.evidence_start) AS s,
+             COALESCE(h.corrected_end,   f.evidence_end)   AS e
+      FROM trope_finding f
+      JOIN temp.scene_pick sp ON sp.id = f.scene_id
+      JOIN v_latest_human h ON h.finding_id = f.id AND h.decision='accept'
+      WHERE COALESCE(h.corrected_start, f.evidence_start) IS NOT NULL
+        AND COALESCE(h.corrected_end,   f.evidence_end)   IS NOT NULL
+    """, (), vocab)
+
     total_tp=total_fp=total_fn=0
-    per_trope = defaultdict(lambda: {'tp':0,'fp':0,'fn':0})
+    # per-trope counters indexed by vocab code
+    tp_t = np.zeros(len(vocab), dtype=np.int64)
+    fp_t = np.zeros(len(vocab), dtype=np.int64)
+    fn_t = np.zeros(len(vocab), dtype=np.int64)
 
     for sid in scene_ids:
-        # predictions at threshold τ
-        preds = fetch(DB, """
-          SELECT id, trope_id, evidence_start AS s, evidence_end AS e, confidence
-          FROM trope_finding
-          WHERE scene_id=? AND confidence >= ?
-        """, (sid, args.threshold))
-
-        # ground truth = accepted latest human decisions (edits allowed)
-        gts = fetch(DB, """
-          SELECT f.id as fid, COALESCE(h.corrected_trope_id, f.trope_id) AS trope_id,
-                 COALESCE(h.corrected_start, f.evidence_start) AS s,
-                 COALESCE(h.corrected_end,   f.evidence_end)   AS e
-          FROM trope_finding f
-          JOIN v_latest_human h ON h.finding_id = f.id AND h.decision='accept'
-          WHERE f.scene_id = ?
-        """, (sid,))
+        pt, ps = preds.get(sid, NO_SPANS)
+        gt_t, gs = gts.get(sid, NO_SPANS)
 
         # match by trope_id + IoU≥θ
-        matched_pred=set(); matched_gt=set()
-        for gi, gt in enumerate(gts):
-            best=None; best_iou=0.0; best_pi=None
-            for pi, pr in enumerate(preds):
-                if pr['trope_id'] != gt['trope_id'] or pi in matched_pred: continue
-                j = iou((pr['s'],pr['e']), (gt['s'],gt['e']))
-                if j>best_iou:
-                    best_iou=j; best=pr; best_pi=pi
-            if best and best_iou >= args.iou:
-                matched_pred.add(best_pi); matched_gt.add(gi)
-                total_tp += 1; per_trope[gt['trope_id']]['tp'] += 1
+        iou_mat = iou_matrix(ps, gs)
+        iou_mat[pt[:,None] != gt_t[None,:]] = 0.0
+        mp, mg = match_spans(iou_mat, args.iou)
+        total_tp += len(mg)
+        np.add.at(tp_t, gt_t[mg], 1)
 
         # leftovers: FPs (unmatched preds) and FNs (unmatched gts)
-        fps = [p for i,p in enumerate(preds) if i not in matched_pred]
-        fns = [g for i,g in enumerate(gts)   if i not in matched_gt ]
-        total_fp += len(fps); total_fn += len(fns)
-        for p in fps: per_trope[p['trope_id']]['fp'] += 1
-        for g in fns: per_trope[g['trope_id']]['fn'] += 1
+        fp_idx = np.setdiff1d(np.arange(len(pt)),   mp, assume_unique=True)
+        fn_idx = np.setdiff1d(np.arange(len(gt_t)), mg, assume_unique=True)
+        total_fp += len(fp_idx); total_fn += len(fn_idx)
+        np.add.at(fp_t, pt[fp_idx],   1)
+        np.add.at(fn_t, gt_t[fn_idx], 1)
 
     prec = total_tp / (total_tp + total_fp) if (total_tp+total_fp)>0 else 0.0
     rec  = total_tp / (total_tp + total_fn) if (total_tp+total_fn)>0 else 0.0
@@ -84,8 +133,8 @@ def main():
     print(f"TP={total_tp} FP={total_fp} FN={total_fn}")
     print(f"Precision={prec:.3f}  Recall={rec:.3f}  F1={f1:.3f}")
     print("\nPer-trope:")
-    for t, m in sorted(per_trope.items(), key=lambda kv: kv[0]):
-        tp,fp,fn = m['tp'],m['fp'],m['fn']
+    for t, k in sorted(vocab.items()):
+        tp,fp,fn = int(tp_t[k]),int(fp_t[k]),int(fn_t[k])
         p = tp/(tp+fp) if (tp+fp)>0 else 0.0
         r = tp/(tp+fn) if (tp+fn)>0 else 0.0
         f = 2*p*r/(p+r) if (p+r)>0 else 0.0
@@ -1,38 +1,133 @@
 # review/scripts/learn_thresholds.py
-import argparse, sqlite3, json, time
-from collections import defaultdict
+import argparse, hashlib, sqlite3, json, time
+from array import array
+from pathlib import Path
 
+import numpy as np
 
-def fetch(conn, sql, args=()):
-    cur = conn.execute(sql, args);
-    cols = [c[0] for c in cur.description]
-    return [dict(zip(cols, row)) for row in cur.fetchall()]
+# below this many labels per trope the NumPy sweep is already cheap
+NJIT_MIN_N = 100_000
 
 
-def best_threshold(points, method="f1"):
+def _sweep_py(s, y):
     """
-    points: list of (score in [0,1], label) where label=1 for accept, 0 for reject.
+    Fused single pass over scores sorted descending (s) and labels (y):
+    running TP/FP, F1 evaluated at the last index of each tied score.
+    Returns (best index, tp, fp, total positives, prec, rec, f1); ties go to
+    the later (smaller) threshold, matching the NumPy sweep.
+    """
+    n = s.shape[0]
+    pos = 0
+    for k in range(n):
+        pos += y[k]
+    tp = 0; fp = 0
+    bi = 0; btp = 0; bfp = 0; bprec = 0.0; brec = 0.0; bf1 = -1.0
+    for i in range(n):
+        if y[i] == 1:
+            tp += 1
+        else:
+            fp += 1
+        if i + 1 < n and s[i + 1] == s[i]:
+            continue
+        prec = tp / (tp + fp)
+        rec = tp / pos if pos > 0 else 0.0
+        f1 = 2 * prec * rec / (prec + rec) if prec + rec > 0 else 0.0
+        if f1 >= bf1:
+            bi = i; btp = tp; bfp = fp; bprec = prec; brec = rec; bf1 = f1
+    return bi, btp, bfp, pos, bprec, brec, bf1
+
+
+_sweep = None  # JIT-compiled _sweep_py, built on first use by _jit_sweep()
+
+
+def _jit_sweep():
+    """
+    numba-compiled _sweep_py, or None when numba isn't installed. Imported and
+    compiled lazily: numba's import alone costs ~0.3 s, and only tropes with
+    >= NJIT_MIN_N labels take this path. cache=True keeps the compiled kernel
+    in __pycache__ (.nbi/.nbc) so later runs skip compilation.
+    """
+    global _sweep
+    if _sweep is None:
+        try:
+            from numba import njit
+        except ImportError:  # numba optional; the NumPy sweep handles every size
+            _sweep = False
+        else:
+            _sweep = njit(cache=True)(_sweep_py)
+    return _sweep or None
+
+
+def load_labels(conn):
+    """
+    Stream labeled findings off the cursor into arrays (no per-row dicts):
+    trope_ids (object), finding_ids (object), scores (float64),
+    labels (int8: 1 accept, 0 reject), ordered by finding id.
+    Labels use the latest decision; edits credit corrected_trope_id.
+    """
+    cur = conn.execute("""
+                       SELECT COALESCE(h.corrected_trope_id, f.trope_id) AS trope_id,
+                              f.id                                       AS finding_id,
+                              COALESCE(f.confidence, 0.0)                AS score,
+                              (h.decision = 'accept')                    AS label
+                       FROM trope_finding f
+                                JOIN v_latest_human h ON h.finding_id = f.id
+                       WHERE h.decision IN ('accept', 'reject')
+                       ORDER BY f.id
+                       """)
+    tids, fids, scores, labels = [], [], array('d'), array('b')
+    for tid, fid, score, label in cur:
+        tids.append(tid); fids.append(fid); scores.append(score); labels.append(label)
+    return (np.array(tids, dtype=object),
+            np.array(fids, dtype=object),
+            np.frombuffer(scores, dtype=np.float64),
+            np.frombuffer(labels, dtype=np.int8))
+
+
+def label_signature(fids, scores, labels):
+    """
+    Digest of one trope's label set: which findings, their scores and their
+    accept/reject labels. Re-scored or re-labeled findings change it, so a
+    matching cached sweep result is still valid.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update("\0".join(map(str, fids)).encode("utf-8"))
+    h.update(np.ascontiguousarray(scores).tobytes())
+    h.update(np.ascontiguousarray(labels).tobytes())
+    return h.hexdigest()
+
+
+def best_threshold(scores, labels, method="f1"):
+    """
+    scores: array of scores in [0,1]; labels: matching array, 1 for accept, 0 for reject.
     We scan unique scores as thresholds (>= t is positive) and pick t maximizing F1.
     Tie-breaker: smallest t achieving best F1.
     """
-    if not points: return 0.5, dict(tp=0, fp=0, fn=0, prec=0.0, rec=0.0, f1=0.0)
-    # uniq sorted descending for classic sweep
-    uniq = sorted(set(s for s, _ in points), reverse=True)
-    # Precompute counts
-    total_pos = sum(1 for _, y in points if y == 1)
-    total_neg = len(points) - total_pos
-    best = (-1.0, 1.0, 0.0, dict(tp=0, fp=0, fn=total_pos, prec=0.0, rec=0.0, f1=0.0))  # (F1, t, P, stats)
-    for t in uniq:
-        tp = sum(1 for s, y in points if s >= t and y == 1)
-        fp = sum(1 for s, y in points if s >= t and y == 0)
-        fn = total_pos - tp
-        prec = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-        rec = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-        f1 = 2 * prec * rec / (prec + rec) if (prec + rec) > 0 else 0.0
-        key = (f1, -t)  # prefer lower t on tie
-        if key > (best[0], -best[1]):
-            best = (f1, t, prec, dict(tp=tp, fp=fp, fn=fn, prec=prec, rec=rec, f1=f1))
-    return best[1], best[3]
+    if len(scores) == 0: return 0.5, dict(tp=0, fp=0, fn=0, prec=0.0, rec=0.0, f1=0.0)
+    # classic sweep: sort descending once, cumulative TP/FP at every cut
+    order = np.argsort(-scores, kind="stable")
+    s, y = scores[order], labels[order]
+    sweep = _jit_sweep() if len(s) >= NJIT_MIN_N else None
+    if sweep is not None:
+        # JIT kernel keeps the running counts in registers instead of
+        # materializing cumsum/prec/rec/f1 arrays
+        i, tp, fp, pos, prec, rec, f1 = sweep(s, y)
+        return float(s[i]), dict(tp=int(tp), fp=int(fp), fn=int(pos - tp),
+                                 prec=float(prec), rec=float(rec), f1=float(f1))
+    tp = np.cumsum(y == 1)
+    fp = np.cumsum(y == 0)
+    # a threshold admits every tied score, so keep the last index per unique value
+    last = np.r_[np.flatnonzero(np.diff(s) != 0), len(s) - 1]
+    s, tp, fp = s[last], tp[last], fp[last]
+    total_pos = int(tp[-1])
+    fn = total_pos - tp
+    prec = tp / np.maximum(tp + fp, 1)
+    rec = tp / max(total_pos, 1)
+    f1 = 2 * prec * rec / np.maximum(prec + rec, 1e-12)
+    # thresholds run high→low; argmax on the reversed array = smallest t on tie
+    i = len(s) - 1 - int(np.argmax(f1[::-1]))
+    return float(s[i]), dict(tp=int(tp[i]), fp=int(fp[i]), fn=int(fn[i]),
+                             prec=float(prec[i]), rec=float(rec[i]), f1=float(f1[i]))
 
 
 def main():
@@ -41,31 +136,66 @@ def main():
     ap.add_argument('--min-count', type=int, default=6, help='min # labeled (accept+reject) per trope')
     ap.add_argument('--out', help='optional thresholds.json output path')
     ap.add_argument('--write-table', action='store_true', help='write results to table trope_threshold')
+    ap.add_argument('--cache-db', help='sidecar SQLite file for memoized sweeps '
+                                       '(default: <db stem>.threshold_cache.db next to --db)')
+    ap.add_argument('--no-cache', action='store_true', help='ignore and skip updating the sweep cache')
     args = ap.parse_args()
 
-    conn = sqlite3.connect(args.db);
-    conn.row_factory = sqlite3.Row
+    conn = sqlite3.connect(args.db)
 
-    # labels: use latest decision; if edited, use corrected_trope_id to credit the right trope
-    rows = fetch(conn, """
-                       SELECT COALESCE(h.corrected_trope_id, f.trope_id)                              AS trope_id,
-                              COALESCE(f.confidence, 0.0)                                             AS score,
-                              CASE h.decision WHEN 'accept' THEN 1 WHEN 'reject' THEN 0 ELSE NULL END AS label
-                       FROM trope_finding f
-                                JOIN v_latest_human h ON h.finding_id = f.id
-                       WHERE h.decision IN ('accept', 'reject')
-                       """)
+    trope_ids, finding_ids, scores, labels = load_labels(conn)
+
+    # group by trope: sort by group index so each trope is one contiguous slice
+    # (stable, so each slice stays in finding-id order for label_signature)
+    tids, inv = np.unique(trope_ids, return_inverse=True)
+    order = np.argsort(inv, kind="stable")
+    fids_s, scores_s, labels_s = finding_ids[order], scores[order], labels[order]
+    bounds = np.searchsorted(inv[order], np.arange(len(tids) + 1))
+    counts = np.diff(bounds)
 
-    by_trope = defaultdict(list)
-    for r in rows:
-        if r["label"] is None: continue
-        by_trope[r["trope_id"]].append((float(r["score"]), int(r["label"])))
+    # memoized sweeps, kept in a sidecar file so the labels DB is only read here:
+    # a trope whose (n, signature) matches the cached row has the same findings,
+    # scores and labels as last run, so its stored result is reused
+    cache, cached, stale = None, {}, []
+    if not args.no_cache:
+        cache_path = args.cache_db or Path(args.db).with_name(Path(args.db).stem + ".threshold_cache.db")
+        cache = sqlite3.connect(cache_path)
+        cache.execute("""
+                      CREATE TABLE IF NOT EXISTS trope_threshold_cache
+                      (
+                          trope_id    TEXT PRIMARY KEY,
+                          n           INTEGER NOT NULL,
+                          signature   TEXT    NOT NULL,
+                          result_json TEXT    NOT NULL
+                      )
+                      """)
+        cached = {tid: (n, sig, rj) for tid, n, sig, rj in
+                  cache.execute("SELECT trope_id, n, signature, result_json FROM trope_threshold_cache")}
 
     results = {}
-    for tid, pts in by_trope.items():
-        if len(pts) < args.min_count: continue
-        thr, stats = best_threshold(pts)
-        results[tid] = dict(threshold=thr, **stats, n=len(pts))
+    for i in np.flatnonzero(counts >= args.min_count):
+        tid = tids[i]
+        a, b = bounds[i], bounds[i + 1]
+        sig = label_signature(fids_s[a:b], scores_s[a:b], labels_s[a:b]) if cache is not None else None
+        hit = cached.get(tid)
+        if hit is not None and hit[:2] == (int(counts[i]), sig):
+            results[tid] = json.loads(hit[2])
+            continue
+        thr, stats = best_threshold(scores_s[a:b], labels_s[a:b])
+        results[tid] = dict(threshold=thr, **stats, n=int(counts[i]))
+        if cache is not None:
+            stale.append((tid, int(counts[i]), sig, json.dumps(results[tid])))
+
+    if cache is not None:
+        if stale:
+            with cache:
+                cache.executemany("""
+                                  INSERT INTO trope_threshold_cache(trope_id, n, signature, result_json)
+                                  VALUES (?, ?, ?, ?) ON CONFLICT(trope_id) DO
+                                  UPDATE SET
+                                      n=excluded.n, signature=excluded.signature, result_json=excluded.result_json
+                                  """, stale)
+        cache.close()
 
     # Optionally write a table
     if args.write_table:
@@ -126,16 +256,18 @@ def main():
                            ))
                                );
                            """)
-        for tid, r in results.items():
-            conn.execute("""
-                         INSERT INTO trope_threshold(trope_id, threshold, n, tp, fp, fn, prec, rec, f1, method, updated_at)
-                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'grid-f1',
-                                 strftime('%Y-%m-%dT%H:%M:%SZ', 'now')) ON CONFLICT(trope_id) DO
-                         UPDATE SET
-                             threshold=excluded.threshold, n=excluded.n, tp=excluded.tp, fp=excluded.fp, fn=excluded.fn,
-                             prec=excluded.prec, rec=excluded.rec, f1=excluded.f1, method =excluded.method, updated_at=excluded.updated_at
-                         """, (tid, r["threshold"], r["n"], r["tp"], r["fp"], r["fn"], r["prec"], r["rec"], r["f1"]))
-        conn.commit()
+        rows_to_write = [(tid, r["threshold"], r["n"], r["tp"], r["fp"], r["fn"], r["prec"], r["rec"], r["f1"])
+                         for tid, r in results.items()]
+        # one prepared upsert bound over all rows, committed atomically
+        with conn:
+            conn.executemany("""
+                             INSERT INTO trope_threshold(trope_id, threshold, n, tp, fp, fn, prec, rec, f1, method, updated_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'grid-f1',
+                                     strftime('%Y-%m-%dT%H:%M:%SZ', 'now')) ON CONFLICT(trope_id) DO
+                             UPDATE SET
+                                 threshold=excluded.threshold, n=excluded.n, tp=excluded.tp, fp=excluded.fp, fn=excluded.fn,
+                                 prec=excluded.prec, rec=excluded.rec, f1=excluded.f1, method =excluded.method, updated_at=excluded.updated_at
+                             """, rows_to_write)
 
     # Optional JSON
     if args.out:
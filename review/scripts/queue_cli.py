@@ -1,14 +1,31 @@
 #!/usr/bin/env python3
 # review/scripts/queue_cli.py
-import argparse, os, sqlite3, shutil, textwrap, re, uuid, time, random
+import argparse, os, sqlite3, shutil, textwrap, uuid, time, random
 
 # --- display-only quote mapping (keeps string length stable) ---------------
 DISPLAY_CHAR_MAP = str.maketrans({"Ò":"“","Ó":"”","Õ":"’","Ô":"—","Ê":"—"})
 def display_fix_quotes(s: str) -> str:
-    return s.translate(DISPLAY_CHAR_MAP) if s else s
+    # all mapped glyphs are non-ASCII; isascii() is a C scan that skips the translate copy
+    return s if (not s or s.isascii()) else s.translate(DISPLAY_CHAR_MAP)
+
+# --- connection tuning -----------------------------------------------------
+# Interactive loop re-runs the same two queries per keystroke: WAL + a big page
+# cache keep hot pages resident; statements are identical strings per session,
+# so sqlite3's statement cache reuses their prepared plans.
+CONN_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+"""
 
 # --- schema bootstrap (view for latest human decision) ---------------------
 def ensure_review_schema(conn: sqlite3.Connection) -> None:
+    # older DBs carry a tie-prone form of the view; replace it with the current one
+    old = conn.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name='v_latest_human'").fetchone()
+    if old and "rowid DESC" not in old[0]:
+        conn.execute("DROP VIEW v_latest_human")
     conn.executescript("""
     PRAGMA foreign_keys=ON;
     CREATE TABLE IF NOT EXISTS trope_finding_human(
@@ -24,15 +41,60 @@ def ensure_review_schema(conn: sqlite3.Connection) -> None:
       FOREIGN KEY(finding_id) REFERENCES trope_finding(id) ON DELETE CASCADE
     );
     CREATE INDEX IF NOT EXISTS idx_tfh_finding ON trope_finding_human(finding_id);
+    CREATE INDEX IF NOT EXISTS idx_tfh_fid_cat ON trope_finding_human(finding_id, created_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_tf_scene_conf ON trope_finding(scene_id, confidence);
 
     CREATE VIEW IF NOT EXISTS v_latest_human AS
     SELECT h.*
     FROM trope_finding_human h
-    JOIN (
-      SELECT finding_id, MAX(created_at) AS mx
-      FROM trope_finding_human
-      GROUP BY finding_id
-    ) last ON last.finding_id=h.finding_id AND last.mx=h.created_at;
+    WHERE h.rowid=(SELECT rowid FROM trope_finding_human WHERE finding_id=h.finding_id
+                   ORDER BY created_at DESC, rowid DESC LIMIT 1);
+    """)
+    conn.commit()
+    ensure_reviewed_flag(conn)
+    # planner stats for the uncertain-order query; gathered once per DB
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+        conn.execute("ANALYZE")
+        conn.commit()
+
+def ensure_reviewed_flag(conn: sqlite3.Connection) -> None:
+    """
+    Denormalized trope_finding.reviewed (1 once any human decision exists,
+    else NULL), kept current by insert/delete triggers. The "no decision yet"
+    test then lives on trope_finding itself, so the partial expression index
+    below turns the uncertain-order queue into an index walk instead of
+    scan + sort. New DBs get the column, triggers and index from
+    ingestion.sql; older ones are migrated here.
+    """
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(trope_finding)")}
+    if "reviewed" not in cols:
+        try:
+            conn.execute("ALTER TABLE trope_finding ADD COLUMN reviewed INTEGER")
+        except sqlite3.OperationalError:
+            pass  # another process added it first
+        # backfill once; the trigger keeps it current from here on
+        conn.execute("""
+          UPDATE trope_finding SET reviewed=1
+          WHERE reviewed IS NULL AND id IN (SELECT finding_id FROM trope_finding_human)""")
+    conn.executescript("""
+    CREATE TRIGGER IF NOT EXISTS tfh_mark_reviewed
+    AFTER INSERT ON trope_finding_human
+    BEGIN
+      UPDATE trope_finding SET reviewed=1 WHERE id=NEW.finding_id AND reviewed IS NULL;
+    END;
+    -- undoing the last decision puts the finding back in the queue
+    CREATE TRIGGER IF NOT EXISTS tfh_unmark_reviewed
+    AFTER DELETE ON trope_finding_human
+    BEGIN
+      UPDATE trope_finding
+      SET reviewed = CASE WHEN EXISTS(SELECT 1 FROM trope_finding_human WHERE finding_id=OLD.finding_id)
+                          THEN 1 ELSE NULL END
+      WHERE id=OLD.finding_id;
+    END;
+    -- keys match order_sql('uncertain') exactly; only unreviewed rows are indexed
+    CREATE INDEX IF NOT EXISTS idx_tf_uncert
+      ON trope_finding(ABS(COALESCE(confidence,0.5)-0.5), COALESCE(created_at,'0000') DESC)
+      WHERE reviewed IS NULL;
     """)
     conn.commit()
 
@@ -70,11 +132,13 @@ def excerpt(scene_text: str, base: int, start_abs: int, end_abs: int,
     pre_ellipsis  = "…" if left_i > 0 else ""
     post_ellipsis = "…" if right_i < len(t) else ""
     out = pre_ellipsis + left + colorize(mid, color, "hl") + right + post_ellipsis
-    # collapse newlines into spaces for a single-line display
-    out = re.sub(r'\s+', ' ', out.strip())
-    # soft wrap for terminal width
-    wrapped = textwrap.fill(out, width=width)
-    return wrapped
+    # collapse newlines into spaces for a single-line display;
+    # split()/join is the same \s+ collapse without the regex engine
+    out = ' '.join(out.split())
+    # soft wrap for terminal width (nothing to wrap when it already fits)
+    if len(out) <= width:
+        return out
+    return textwrap.fill(out, width=width)
 
 def parse_edit(expr: str, cur_start: int, cur_end: int):
     """
@@ -82,12 +146,19 @@ def parse_edit(expr: str, cur_start: int, cur_end: int):
       - '123 145' or '123,145'          → absolute
       - '+10 -5'   or '+10,-5'          → relative (delta start, delta end)
     """
-    m = re.match(r'^\s*([+-]?\d+)\s*[, ]\s*([+-]?\d+)\s*$', expr or '')
-    if not m: return None
-    a, b = m.group(1), m.group(2)
+    # two signed ints split by one comma or whitespace; str ops, no regex
+    head, comma, tail = (expr or '').partition(',')
+    parts = [head.strip(), tail.strip()] if comma else head.split()
+    if len(parts) != 2: return None
+    a, b = parts
+    if '_' in a or '_' in b: return None  # int() takes '1_000'; the grammar doesn't
+    try:
+        ai, bi = int(a), int(b)
+    except ValueError:
+        return None
     if a.startswith(('+','-')) or b.startswith(('+','-')):
-        return cur_start + int(a), cur_end + int(b)
-    return int(a), int(b)
+        return cur_start + ai, cur_end + bi
+    return ai, bi
 
 def count_remaining(conn, where_sql, args):
     row = conn.execute(f"""
@@ -99,7 +170,9 @@ def count_remaining(conn, where_sql, args):
     return int(row[0]) if row else 0
 
 def build_filters(args):
-    where = ["h.finding_id IS NULL"]
+    # skipped: session-local TEMP table (see main), so skips never grow the WHERE
+    # f.reviewed IS NULL lets the planner use the partial idx_tf_uncert
+    where = ["f.reviewed IS NULL", "h.finding_id IS NULL", "f.id NOT IN (SELECT id FROM skipped)"]
     vals  = []
     if args.work_id:
         where.append("f.work_id = ?"); vals.append(args.work_id)
@@ -125,7 +198,8 @@ def get_next(conn, where_sql, args, ord_sql):
         f.evidence_start AS start, f.evidence_end AS end, f.rationale,
         t.name AS trope,
         s.idx AS scene_idx, s.char_start, s.char_end,
-        w.title, w.author, w.norm_text
+        w.title, w.author,
+        substr(w.norm_text, s.char_start+1, s.char_end-s.char_start) AS scene_text
       FROM trope_finding f
       JOIN scene s ON s.id=f.scene_id
       JOIN work  w ON w.id=f.work_id
@@ -136,26 +210,35 @@ def get_next(conn, where_sql, args, ord_sql):
       LIMIT 1
     """, args).fetchone()
 
+# writers below don't commit; callers wrap each prompt cycle in one
+# `with conn: conn.execute("BEGIN IMMEDIATE")` transaction (one fsync)
 def insert_decision(conn, finding_id, decision, note=None, reviewer=None):
     conn.execute(
         "INSERT INTO trope_finding_human(id,finding_id,decision,note,reviewer) VALUES(?,?,?,?,?)",
         (str(uuid.uuid4()), finding_id, decision, note, reviewer)
     )
-    conn.commit()
 
-def apply_edit(conn, finding_id, start, end, trope_id=None, note=None, reviewer=None):
-    # clamp to doc length and enforce start < end
+def check_edit(conn, finding_id, start, end):
+    # read-only: clamp to doc length and enforce start < end
+    # → ((start, end), None) if the edit would apply, else (None, error)
     row = conn.execute("""
       SELECT f.work_id, COALESCE(length(w.norm_text),0) AS n
       FROM trope_finding f JOIN work w ON w.id=f.work_id
       WHERE f.id=?""", (finding_id,)).fetchone()
     if not row:
-        return False, "finding not found"
+        return None, "finding not found"
     N = int(row["n"])
     start = clamp(start, 0, N)
     end   = clamp(end,   0, N)
     if end <= start:
-        return False, "end must be > start"
+        return None, "end must be > start"
+    return (start, end), None
+
+def apply_edit(conn, finding_id, start, end, trope_id=None, note=None, reviewer=None):
+    span, err = check_edit(conn, finding_id, start, end)
+    if not span:
+        return False, err
+    start, end = span
 
     # history row
     conn.execute("""
@@ -171,7 +254,6 @@ def apply_edit(conn, finding_id, start, end, trope_id=None, note=None, reviewer=
     else:
         conn.execute("UPDATE trope_finding SET evidence_start=?, evidence_end=? WHERE id=?",
                      (start, end, finding_id))
-    conn.commit()
     return True, None
 
 def main():
@@ -188,9 +270,12 @@ def main():
     ap.add_argument("--reviewer", default=os.getenv("REVIEWER",""))
     args = ap.parse_args()
 
-    conn = sqlite3.connect(args.db)
+    # autocommit mode: no implicit per-statement BEGIN; writes use explicit BEGIN IMMEDIATE
+    conn = sqlite3.connect(args.db, cached_statements=256, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    conn.executescript(CONN_PRAGMAS)
     ensure_review_schema(conn)
+    conn.execute("CREATE TEMP TABLE skipped(id TEXT PRIMARY KEY)")
 
     where_sql, vals = build_filters(args)
     ord_sql = order_sql(args.order)
@@ -205,9 +290,9 @@ def main():
             print("No more unreviewed findings matching current filters.")
             break
 
-        # scene slice + display
-        s0, s1 = int(row["char_start"]), int(row["char_end"])
-        scene_text = display_fix_quotes((row["norm_text"] or "")[s0:s1])
+        # scene slice (cut in SQL) + display; s0 maps absolute offsets to scene-relative
+        s0 = int(row["char_start"])
+        scene_text = display_fix_quotes(row["scene_text"] or "")
         title = f"{row['title']} — Scene #{row['scene_idx']}"
         meta  = f"work={row['work_id']}  trope={row['trope']}  conf={row['confidence']:.2f}  span=[{row['start']}–{row['end']}]"
 
@@ -232,28 +317,23 @@ def main():
         if choice in ("q","quit","x","exit"):
             break
         elif choice in ("n","next","s","skip",""):
-            # skip; exclude this id by adding a one-off "after" filter (cheap way: insert temp row into h to skip? Better: just change WHERE)
-            # We won't mutate WHERE; we'll just insert a transient reject? No. We keep it simple: add a small in-memory set.
-            # Easiest: insert a temporary no-op decision? Avoid polluting history. So just reshuffle order when random, or continue (we may get same item).
-            # To guarantee forward progress, temporarily consider it "reviewed" in this loop by adding a local exclusion.
-            vals2 = vals + [row["id"]]
-            row2 = conn.execute(f"""
-              SELECT COUNT(1) FROM trope_finding f LEFT JOIN v_latest_human h ON h.finding_id=f.id
-              WHERE {where_sql} AND f.id <> ?""", vals2).fetchone()
-            if int(row2[0]) == 0:
+            # skip: exclude this id for the rest of the session
+            conn.execute("INSERT OR IGNORE INTO skipped(id) VALUES(?)", (row["id"],))
+            if count_remaining(conn, where_sql, vals) == 0:
                 print("No more items after skipping.")
                 break
-            # mutate WHERE for this process only
-            where_sql += " AND f.id <> ?"
-            vals.append(row["id"])
             continue
 
         elif choice in ("a","accept","y","yes"):
-            insert_decision(conn, row["id"], "accept", reviewer=args.reviewer or None)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                insert_decision(conn, row["id"], "accept", reviewer=args.reviewer or None)
             decided += 1
 
         elif choice in ("r","reject","no"):
-            insert_decision(conn, row["id"], "reject", reviewer=args.reviewer or None)
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                insert_decision(conn, row["id"], "reject", reviewer=args.reviewer or None)
             decided += 1
 
         elif choice in ("e","edit"):
@@ -263,14 +343,24 @@ def main():
             if not se:
                 print("! Could not parse. Skipping edit.")
                 continue
-            ok, err = apply_edit(conn, row["id"], se[0], se[1], note="cli-edit", reviewer=args.reviewer or None)
+            # validate before prompting, so the accept question is only asked
+            # for an edit that will apply
+            _, err = check_edit(conn, row["id"], se[0], se[1])
+            if err:
+                print(f"! Edit failed: {err}")
+                continue
+            # optional fast accept after edit; asked up front so edit + accept
+            # land in one transaction without holding the write lock during input
+            accept = input("Accept after edit? [y/N]: ").strip().lower() in ("y","yes")
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                ok, err = apply_edit(conn, row["id"], se[0], se[1], note="cli-edit", reviewer=args.reviewer or None)
+                if ok and accept:
+                    insert_decision(conn, row["id"], "accept", reviewer=args.reviewer or None)
             if not ok:
                 print(f"! Edit failed: {err}")
                 continue
-            # optional fast accept after edit
-            ch = input("Accept after edit? [y/N]: ").strip().lower()
-            if ch in ("y","yes"):
-                insert_decision(conn, row["id"], "accept", reviewer=args.reviewer or None)
+            if accept:
                 decided += 1
         else:
             print("…unknown command; use A/R/E/N/Q")
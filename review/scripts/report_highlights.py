@@ -1,5 +1,9 @@
 # scripts/report_highlights.py
-import argparse, html, os, sqlite3, re
+import argparse, heapq, html, json, os, sqlite3, re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 
 CSS = """
@@ -10,6 +14,7 @@ header{position:sticky;top:0;background:#fff;border-bottom:1px solid #eee;paddin
 .scene h3{margin:0;padding:10px 12px;background:#fafafa;border-bottom:1px solid #eee;font-weight:600}
 .scene pre{margin:0;padding:12px 12px 16px;white-space:pre-wrap}
 mark{background:#fff59d;border-radius:2px;padding:0 .1em}
+mark mark{background:#ffd54f;padding:0}
 .legend{display:flex;flex-wrap:wrap;gap:.5em;margin-top:8px}
 .badge{display:inline-block;padding:.1em .4em;border-radius:3px;background:#eee}
 .small{opacity:.7;font-size:.9em}
@@ -29,73 +34,158 @@ document.addEventListener('click', (e)=>{
 def sanitize(title: str) -> str:
     return re.sub(r'[^A-Za-z0-9._-]+','_', title.strip()) or "work"
 
+# same output as html.escape(s, quote=True), as one C-level str.translate pass
+_HTML_TT = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
 def wrap_with_marks(text: str, spans):
     # spans: list of dicts with s,e, id, trope
-    # assumes s/e are scene-relative code-point indices
-    spans = sorted([s for s in spans if s['e']>s['s']], key=lambda x:(x['s'], x['e']))
+    # assumes s/e are scene-relative code-point indices.
+    # Overlaps are nested, not garbled: one sweep in start order with a min-heap
+    # of active end points. A span that closes while an inner one is still open
+    # closes the inner marks and reopens them as id-less continuations, so the
+    # HTML stays well-formed and every span id appears exactly once.
+    n = len(text); tt = _HTML_TT
+    # longer first on equal starts so the outer mark opens first
+    spans = sorted(((min(sp['s'],n), min(sp['e'],n), i, sp) for i, sp in enumerate(spans) if sp['e']>sp['s']),
+                   key=lambda x:(x[0], -x[1], x[2]))
     out=[]; pos=0
-    for sp in spans:
-        s,e = sp['s'], sp['e']
-        if s>pos: out.append(html.escape(text[pos:s]))
-        out.append(f'<mark data-span-id="{html.escape(sp["id"])}" title="{html.escape(sp["trope"])}">{html.escape(text[s:e])}</mark>')
-        pos=e
-    out.append(html.escape(text[pos:]))
+    stack=[]   # open spans, outermost first
+    ends=[]    # heap of (end, seq) for open spans
+
+    def open_mark(item, reopen=False):
+        sp = item[3]
+        if stack:
+            # nested: title/data-trope list every active trope, outermost first
+            tropes = [x[3]['trope'] for x in stack] + [sp['trope']]
+            attrs = f' title="{" | ".join(tropes).translate(tt)}" data-trope="{"|".join(tropes).translate(tt)}"'
+        else:
+            attrs = f' title="{sp["trope"].translate(tt)}"'
+        out.append(f'<mark class="cont"{attrs}>' if reopen else f'<mark data-span-id="{sp["id"].translate(tt)}"{attrs}>')
+        stack.append(item)
+        if not reopen: heapq.heappush(ends, (item[1], item[2]))  # reopened spans keep their heap entry
+
+    def close_until(limit):
+        nonlocal pos
+        while ends and ends[0][0] <= limit:
+            p = ends[0][0]
+            closing = set()
+            while ends and ends[0][0] == p:
+                closing.add(heapq.heappop(ends)[1])
+            if p > pos: out.append(text[pos:p].translate(tt))
+            pos = max(pos, p)
+            # unwind to the outermost closing span, then reopen the survivors
+            k = min(j for j, x in enumerate(stack) if x[2] in closing)
+            unwound = stack[k:]; del stack[k:]
+            out.append('</mark>' * len(unwound))
+            for x in unwound:
+                if x[2] not in closing: open_mark(x, reopen=True)
+
+    for item in spans:
+        close_until(item[0])
+        if item[0] > pos: out.append(text[pos:item[0]].translate(tt))
+        pos = max(pos, item[0])
+        open_mark(item)
+    close_until(n)
+    out.append(text[pos:].translate(tt))
     return ''.join(out)
 
-def fetch(conn, sql, args=()):
+def iter_fetch(conn, sql, args=()):
+    # one dict per row, straight off the cursor (no fetchall)
     cur = conn.execute(sql, args); cols=[c[0] for c in cur.description]
-    return [dict(zip(cols,row)) for row in cur.fetchall()]
+    for row in cur:
+        yield dict(zip(cols,row))
 
-def build_for_work(conn, work):
+def fetch(conn, sql, args=()):
+    # materialized form, for results that need random access or len()
+    return list(iter_fetch(conn, sql, args))
+
+def fetch_by_work(conn, sql, work_ids):
+    # one bulk query for all selected works (ids bound as a JSON array), rows
+    # ordered by work_id in SQL and grouped here: {work_id: [row dicts]}
+    rows = iter_fetch(conn, sql, (json.dumps(work_ids),))
+    return {wid: list(g) for wid, g in groupby(rows, key=itemgetter('work_id'))}
+
+def _dedup_key(f):
+    return (f['trope'], f['s'], f['e'], f['scene_id'])
+
+def build_for_work(conn, work, out_fp, findings=()):
+    # writes the report straight to out_fp (newline-separated pieces) rather
+    # than building the whole document in memory.
+    # work: id/title/author row; findings: this work's rows (with scene_idx) from
+    # the bulk query in main(). Only the scenes are read per work (text sliced in SQL).
     wid = work['id']
-    # scenes
-    scenes = fetch(conn, "SELECT id,idx,char_start,char_end FROM scene WHERE work_id=? ORDER BY idx", (wid,))
-    # findings
-    frows = fetch(conn, """
-      SELECT f.id,f.scene_id,f.evidence_start AS s,f.evidence_end AS e, t.name AS trope
-      FROM trope_finding f JOIN trope t ON t.id=f.trope_id
-      WHERE f.work_id=?
-      ORDER BY f.scene_id,f.evidence_start,f.evidence_end
-    """, (wid,))
-    # text
-    wrow = fetch(conn, "SELECT norm_text,title,author FROM work WHERE id=?", (wid,))[0]
-    text, title, author = wrow['norm_text'], wrow.get('title') or wid, wrow.get('author') or '—'
-
-    # group findings by scene
-    by_scene={}
-    for f in frows:
-        by_scene.setdefault(f['scene_id'],[]).append(f)
-
-    # assemble HTML
-    parts=[f"<!doctype html><meta charset='utf-8'><title>Highlights — {html.escape(title)}</title>",
-           f"<style>{CSS}</style><header><div class='container'><h1 style='margin:0'>Highlights — {html.escape(title)}</h1><div class='small'>{html.escape(author)}</div></div></header>",
-           "<div class='container'>",
-           "<div class='legend small'><span class='badge'>Click any finding in the list below to jump to its highlight.</span></div>"]
-
-    # flat list of findings (jump links)
-    parts.append("<h2>Findings</h2><ol>")
-    for f in frows:
-        parts.append(f"<li><a href='#' data-jump='{f['id']}'>{html.escape(f['trope'])}</a> "
-                     f"<span class='small'>(scene {next((s['idx'] for s in scenes if s['id']==f['scene_id']), '?')}, {f['s']}–{f['e']})</span></li>")
-    parts.append("</ol>")
-
-    # scenes with highlights
-    for s in scenes:
-        s_id=s['id']; start=s['char_start']; end=s['char_end']
-        scene_text = text[start:end]
+    title, author = work.get('title') or wid, work.get('author') or '—'
+
+    # emit HTML
+    w = out_fp.write
+    w(f"<!doctype html><meta charset='utf-8'><title>Highlights — {html.escape(title)}</title>\n")
+    w(f"<style>{CSS}</style><header><div class='container'><h1 style='margin:0'>Highlights — {html.escape(title)}</h1><div class='small'>{html.escape(author)}</div></div></header>\n")
+    w("<div class='container'>\n")
+    w("<div class='legend small'><span class='badge'>Click any finding in the list below to jump to its highlight.</span></div>\n")
+
+    # flat list of findings (jump links); identical (trope, span, scene) findings,
+    # e.g. from repeated model passes, collapse into the first one with a ×N badge
+    counts = Counter(_dedup_key(f) for f in findings)
+    seen = set()
+    w("<h2>Findings</h2><ol>\n")
+    for f in findings:
+        k = _dedup_key(f)
+        if k in seen: continue
+        seen.add(k)
+        badge = f" <span class='badge'>×{counts[k]}</span>" if counts[k] > 1 else ""
+        w(f"<li><a href='#' data-jump='{f['id']}'>{html.escape(f['trope'])}</a>{badge} "
+          f"<span class='small'>(scene {'?' if f['scene_idx'] is None else f['scene_idx']}, {f['s']}–{f['e']})</span></li>\n")
+    w("</ol>\n")
+
+    # scenes with highlights: findings arrive in scene order (idx, id), the same
+    # order as the scene cursor, so each scene's group is merged in one walk
+    groups = groupby(findings, key=itemgetter('scene_id'))
+    g_sid, g_rows = next(groups, (None, ()))
+    # stream one scene slice at a time so the full norm_text never lands in Python
+    for s_id, idx, start, end, scene_text in conn.execute("""
+      SELECT s.id, s.idx, s.char_start, s.char_end,
+             COALESCE(substr(w.norm_text, s.char_start+1, MAX(s.char_end-s.char_start, 0)), '')
+      FROM scene s JOIN work w ON w.id=s.work_id
+      WHERE s.work_id=? ORDER BY s.idx, s.id
+    """, (wid,)):
         # convert absolute → scene-relative
-        spans = [{'id':f['id'], 's':max(0,f['s']-start),'e':max(0,f['e']-start),'trope':f['trope']} for f in by_scene.get(s_id,[])]
-        html_body = wrap_with_marks(scene_text, spans)
-        parts.append(f"<div class='scene'><h3>Scene {s['idx']} <span class='small'>[{start}–{end}]</span></h3><pre>{html_body}</pre></div>")
-
-    parts.append(f"<script>{JS}</script></div>")
-    return '\n'.join(parts)
+        spans = []
+        if s_id == g_sid:
+            # one mark per deduplicated finding; its id is the one the list links to
+            by_key = {}
+            for f in g_rows: by_key.setdefault(_dedup_key(f), f)
+            spans = [{'id':f['id'], 's':max(0,f['s']-start),'e':max(0,f['e']-start),'trope':f['trope']} for f in by_key.values()]
+            g_sid, g_rows = next(groups, (None, ()))
+        w(f"<div class='scene'><h3>Scene {idx} <span class='small'>[{start}–{end}]</span></h3><pre>")
+        w(wrap_with_marks(scene_text, spans))
+        w("</pre></div>\n")
+
+    w(f"<script>{JS}</script></div>")
+
+# --- parallel rendering: one read-only connection per worker process -------
+_WORKER_CONN = None
+
+def _open_ro(db_path):
+    return sqlite3.connect(Path(db_path).resolve().as_uri() + "?mode=ro", uri=True)
+
+def _init_worker(db_path):
+    global _WORKER_CONN
+    _WORKER_CONN = _open_ro(db_path)
+
+def render_work(work, path, findings):
+    # worker entry point: each work's report is independent, so workers stream
+    # straight to their own file and only the path comes back
+    # 1 MiB buffer: few large write syscalls while the report streams out
+    with open(path, "w", encoding="utf-8", buffering=1 << 20) as fp:
+        build_for_work(_WORKER_CONN, work, fp, findings)
+    return path
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument('--db', required=True)
     ap.add_argument('--work-id')
     ap.add_argument('--title')  # exact match
+    ap.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='worker processes for batch runs')
     args = ap.parse_args()
 
     conn = sqlite3.connect(args.db)
@@ -110,11 +200,37 @@ def main():
 
     outdir = Path("reports"); outdir.mkdir(parents=True, exist_ok=True)
 
+    # findings (with their scene's idx) for every selected work: one query, not one per work
+    ids = [w['id'] for w in works]
+    findings_by_work = fetch_by_work(conn, """
+      SELECT f.work_id,f.id,f.scene_id,s.idx AS scene_idx,f.evidence_start AS s,f.evidence_end AS e, t.name AS trope
+      FROM trope_finding f JOIN trope t ON t.id=f.trope_id
+      LEFT JOIN scene s ON s.id=f.scene_id AND s.work_id=f.work_id
+      WHERE f.work_id IN (SELECT value FROM json_each(?))
+      -- reading order, matching the scene walk in build_for_work; scene-less findings last
+      ORDER BY f.work_id,s.idx IS NULL,s.idx,s.id,f.evidence_start,f.evidence_end
+    """, ids)
+
+    # output path → work; on a file-name collision the later work wins, as
+    # with sequential overwrites, and no two workers ever share a file
+    jobs = {}
     for w in works:
-        html_doc = build_for_work(conn, w)
-        name = sanitize(w.get('title') or w['id']) + ".html"
-        (outdir / name).write_text(html_doc, encoding="utf-8")
-        print(f"✔ wrote {outdir/name}")
+        path = outdir / (sanitize(w.get('title') or w['id']) + ".html")
+        jobs.pop(path, None); jobs[path] = w
+
+    if args.jobs <= 1 or len(jobs) <= 1:
+        _init_worker(args.db)
+        for path, w in jobs.items():
+            render_work(w, path, findings_by_work.get(w['id'], []))
+            print(f"✔ wrote {path}")
+        return
+
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(jobs)),
+                             initializer=_init_worker, initargs=(args.db,)) as ex:
+        futs = [ex.submit(render_work, w, path, findings_by_work.get(w['id'], []))
+                for path, w in jobs.items()]
+        for fut in as_completed(futs):
+            print(f"✔ wrote {fut.result()}")
 
 if __name__ == "__main__":
     main()
@@ -1,42 +1,105 @@
 # scripts/verify_spans.py
-import argparse, os, re, sqlite3, math, requests, json
+import argparse, hashlib, os, re, sqlite3, math, requests, json
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+import numpy as np
 import chromadb
 
-def cosine(a,b):
-    num = sum(x*y for x,y in zip(a,b))
-    da = math.sqrt(sum(x*x for x in a)); db = math.sqrt(sum(y*y for y in b))
-    return 0.0 if da==0 or db==0 else num/(da*db)
+# texts/embeddings per Ollama or Chroma request when fanning out over threads
+BATCH = 64
+
+# one keep-alive session for every Ollama call; main() sizes its pool to --workers
+_SESSION = requests.Session()
+
+def unit(v):
+    # L2-normalize along the last axis as float32 (zero vectors stay zero),
+    # so cosine similarity is a plain dot product: unit(a) @ unit(b)
+    v = np.asarray(v, dtype=np.float32)
+    n = np.linalg.norm(v, axis=-1, keepdims=True)
+    return np.divide(v, n, out=np.zeros_like(v), where=n > 0)
 
 def embed(texts, base, model):
-    url = f"{base.rstrip('/')}/api/embeddings"
-    out=[]
-    for t in texts:
-        r = requests.post(url, json={"model": model, "prompt": t})
-        r.raise_for_status()
-        out.append(r.json()["embedding"])
-    return out
+    # one batched call (/api/embed takes a list of inputs) instead of one POST per text
+    if not texts: return []
+    url = f"{base.rstrip('/')}/api/embed"
+    r = _SESSION.post(url, json={"model": model, "input": list(texts)})
+    r.raise_for_status()
+    return r.json()["embeddings"]
+
+def cached_embed(cache, texts, base, model, workers):
+    """
+    embed() behind a persistent cache: table embed_cache(h, v) in the sidecar
+    connection `cache`, h = sha1(model \\0 text), v = float32 bytes. One lookup
+    query for all texts; only misses (deduplicated) go to Ollama, and they are
+    stored in a single transaction. Returns (N, d) float32.
+    """
+    cache.execute("CREATE TABLE IF NOT EXISTS embed_cache(h TEXT PRIMARY KEY, v BLOB NOT NULL)")
+    hs = [hashlib.sha1(f"{model}\0{t}".encode("utf-8")).hexdigest() for t in texts]
+    vecs = {h: np.frombuffer(v, dtype=np.float32) for h, v in cache.execute(
+        "SELECT h, v FROM embed_cache WHERE h IN (SELECT value FROM json_each(?))", (json.dumps(hs),))}
+    miss = {h: t for h, t in zip(hs, texts) if h not in vecs}
+    if miss:
+        fresh = in_batches(lambda b: embed(b, base, model), list(miss.values()), workers)
+        rows = []
+        for h, v in zip(miss, fresh):
+            vecs[h] = np.asarray(v, dtype=np.float32)
+            rows.append((h, vecs[h].tobytes()))
+        with cache:
+            cache.executemany("INSERT OR REPLACE INTO embed_cache(h, v) VALUES (?, ?)", rows)
+    return np.stack([vecs[h] for h in hs])
+
+def local_sims(chunks, embs, topk):
+    # mean (1 - cosine distance) over top-K chunks, one batched Chroma query for all embeddings
+    if not embs: return []
+    top = chunks.query(query_embeddings=embs, n_results=topk)
+    dists = (top or {}).get("distances") or []
+    # Chroma returns distances; for cosine space, distance ~ (1 - cosine). Convert.
+    return [sum(1.0 - d for d in ds)/len(ds) if ds else None for ds in dists] + [None]*(len(embs)-len(dists))
+
+def in_batches(fn, items, workers):
+    # fn(list) -> list, applied to BATCH-sized slices on a thread pool; requests and
+    # Chroma release the GIL on I/O, so slices overlap. Results keep input order.
+    if not items: return []
+    slices = [items[i:i+BATCH] for i in range(0, len(items), BATCH)]
+    if workers <= 1 or len(slices) == 1:
+        return [x for sl in slices for x in fn(sl)]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return [x for part in ex.map(fn, slices) for x in part]
+
+def local_topk_sims(C, Q, topk):
+    # in-process counterpart of local_sims: C (n_chunks, d) and Q (N, d) unit rows;
+    # mean cosine of each query's top-K chunks via one GEMM + argpartition
+    k = min(topk, C.shape[0])
+    S = Q @ C.T
+    idx = np.argpartition(-S, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(S, idx, axis=1).mean(axis=1).tolist()
+
+# sentence terminator run + trailing whitespace; compiled once at import
+_SENT_RE = re.compile(r'(?:[.!?]|—)+\s+')
 
 def sentence_bounds(s):
     # simple sentence tokenizer: split on .,?!— and line breaks keeping spans
     # we return indices of sentence boundaries
-    seps = re.finditer(r'([.!?]|—)+\s+', s)
     idx=[0]
-    for m in seps:
-        idx.append(m.end())
+    idx.extend(m.end() for m in _SENT_RE.finditer(s))
     if idx[-1] != len(s): idx.append(len(s))
     return idx
 
-def snap_to_sentence(scene_text, abs_start, abs_end, scene_abs_start):
+def snap_to_sentence(bounds, abs_start, abs_end, scene_abs_start):
+    # bounds: sentence_bounds(scene_text), computed once per scene;
+    # sorted, starting at 0 and ending at len(scene_text)
+    n = bounds[-1]
     # convert to scene-relative
     s = max(0, abs_start - scene_abs_start)
     e = max(0, abs_end   - scene_abs_start)
-    s = min(s, len(scene_text)); e = min(max(e,s+1), len(scene_text))
+    s = min(s, n); e = min(max(e,s+1), n)
 
-    bounds = sentence_bounds(scene_text)
-    # find nearest left boundary <= s, and right boundary >= e
-    left  = max([b for b in bounds if b <= s] or [0])
-    right = min([b for b in bounds if b >= e] or [len(scene_text)])
+    # find nearest left boundary <= s, and right boundary >= e (binary search)
+    left  = bounds[bisect_right(bounds, s) - 1]
+    right = bounds[bisect_left(bounds, e)]
     return (scene_abs_start + left, scene_abs_start + right)
 
 def main():
@@ -46,9 +109,24 @@ def main():
     ap.add_argument('--apply', action='store_true')
     ap.add_argument('--delta', type=float, default=0.05, help="min similarity gain to adopt snapped span")
     ap.add_argument('--topk', type=int, default=3, help="top-K chunks for local coherence")
+    ap.add_argument('--workers', type=int, default=8, help="parallel Ollama/Chroma requests")
+    ap.add_argument('--cache-db', help="sidecar SQLite file for embed_cache "
+                                       "(default: <db stem>.embed_cache.db next to --db)")
+    ap.add_argument('--no-cache', action='store_true', help="always re-embed; skip the embed cache")
     args = ap.parse_args()
 
+    # at least one pooled connection per worker thread, so none are discarded
+    pool = HTTPAdapter(pool_connections=16, pool_maxsize=max(16, args.workers))
+    _SESSION.mount("http://", pool)
+    _SESSION.mount("https://", pool)
+
     DB = sqlite3.connect(args.db); DB.row_factory = sqlite3.Row
+    if args.apply:
+        # WAL + busy_timeout: --apply can run alongside the review app without "database is locked";
+        # dry runs only read, so they leave the DB file (and its journal mode) alone
+        DB.execute("PRAGMA journal_mode=WAL")
+        DB.execute("PRAGMA synchronous=NORMAL")
+        DB.execute("PRAGMA busy_timeout=5000")
 
     # env
     OLLAMA = os.getenv("OLLAMA_BASE_URL","http://127.0.0.1:11434")
@@ -76,46 +154,79 @@ def main():
 
     rows = q.fetchall()
     print(f"# findings: {len(rows)}")
+    if not rows: return
 
+    # sentence boundaries once per scene, shared by all of its findings
+    scene_bounds = {sid: sentence_bounds(work["norm_text"][scenes[sid]["char_start"]:scenes[sid]["char_end"]])
+                    for sid in {r["scene_id"] for r in rows}}
+
+    # pass 1 (pure Python): span text + sentence snap for every finding, so the
+    # embedding and Chroma stages below run as batched, parallel requests
+    span_texts, snaps, snapped_texts = [], [], []
     for r in rows:
       srec = scenes[r["scene_id"]]
-      scene_text = work["norm_text"][srec["char_start"]:srec["char_end"]]
       span_text = work["norm_text"][r["s"]:r["e"]]
+      span_texts.append(span_text)
+      ns, ne = snap_to_sentence(scene_bounds[r["scene_id"]], r["s"], r["e"], srec["char_start"])
+      snapped_text = work["norm_text"][ns:ne] if (ns,ne) != (r["s"], r["e"]) else None
+      # a snap that only adds/drops surrounding whitespace can't change the
+      # embedding meaningfully; treat it as unchanged and skip its round-trip
+      if snapped_text is None or snapped_text.strip() == span_text.strip():
+          snaps.append(None)
+      else:
+          snaps.append((ns, ne))
+          snapped_texts.append(snapped_text)
+
+    # embeddings: spans then snapped candidates, BATCH texts per request
+    texts = span_texts + snapped_texts
+    if args.no_cache:
+        embs = in_batches(lambda b: embed(b, OLLAMA, EMBED_MODEL), texts, args.workers)
+    else:
+        # reruns (e.g. tuning --delta) hit the cache instead of Ollama
+        cache_path = args.cache_db or Path(args.db).with_name(Path(args.db).stem + ".embed_cache.db")
+        with closing(sqlite3.connect(cache_path)) as cache:
+            embs = cached_embed(cache, texts, OLLAMA, EMBED_MODEL, args.workers)
+    E = unit(embs)  # (N, d), normalized once; sims below are dot products
+
+    # local coherence: top-K nearest chunks for every embedding. Pull this work's
+    # chunk vectors once and rank them locally; fall back to Chroma queries
+    # (BATCH per query) when the collection has none tagged with this work_id.
+    C = None
+    try:
+        g = chunks.get(where={"work_id": work["id"]}, include=["embeddings"])
+        if len(g["ids"]):
+            C = unit(g["embeddings"])
+    except Exception:
+        pass
+    if C is not None and args.topk > 0:
+        loc = local_topk_sims(C, E, args.topk)
+    else:
+        # normalized rows: cosine distances are scale-invariant
+        loc = in_batches(lambda b: local_sims(chunks, b, args.topk), E.tolist(), args.workers)
+    span_embs, span_locs = E[:len(rows)], loc[:len(rows)]
+    snapped = iter(zip(E[len(rows):], loc[len(rows):]))
 
-      # embeddings
-      span_emb = embed([span_text], OLLAMA, EMBED_MODEL)[0]
-
-      # trope embedding (id = trope_id stored as document id in trope collection)
-      trope_vec = None
-      try:
-          g = tropes.get(ids=[r["trope_id"]], include=["embeddings"])
-          if g["embeddings"] and len(g["embeddings"])==1:
-              trope_vec = g["embeddings"][0]
-      except Exception:
-          pass
-
-      trope_sim = cosine(span_emb, trope_vec) if trope_vec is not None else None
-
-      # local coherence: query top-K nearest chunks
-      # note: collection must contain chunk embeddings for this work; we filter by metadata if present
-      top = chunks.query(query_embeddings=[span_emb], n_results=args.topk)
-      local_sim = None
-      if top and top.get("distances"):
-          # Chroma returns distances; for cosine space, distance ~ (1 - cosine). Convert.
-          ds = top["distances"][0]
-          local_sim = sum(1.0 - d for d in ds)/len(ds)
-
-      # sentence snap
-      ns, ne = snap_to_sentence(scene_text, r["s"], r["e"], srec["char_start"])
-      if (ns,ne) != (r["s"], r["e"]):
-          snapped_text = work["norm_text"][ns:ne]
-          snapped_emb = embed([snapped_text], OLLAMA, EMBED_MODEL)[0]
-          snapped_trope_sim = cosine(snapped_emb, trope_vec) if trope_vec is not None else None
-          snapped_local_top = chunks.query(query_embeddings=[snapped_emb], n_results=args.topk)
-          snapped_local_sim = None
-          if snapped_local_top and snapped_local_top.get("distances"):
-              ds = snapped_local_top["distances"][0]
-              snapped_local_sim = sum(1.0 - d for d in ds)/len(ds)
+    # trope embeddings (id = trope_id stored as document id in trope collection):
+    # one get for every distinct trope in this work, normalized once
+    trope_vecs = {}
+    try:
+        g = tropes.get(ids=sorted({r["trope_id"] for r in rows}), include=["embeddings"])
+        if len(g["ids"]):
+            trope_vecs = dict(zip(g["ids"], unit(g["embeddings"])))
+    except Exception:
+        pass
+
+    # --apply edits, written together after the pass (one transaction, one fsync)
+    history_rows, update_rows = [], []
+    for r, span_emb, local_sim, snap in zip(rows, span_embs, span_locs, snaps):
+      trope_vec = trope_vecs.get(r["trope_id"])
+      trope_sim = float(span_emb @ trope_vec) if trope_vec is not None else None
+
+      # sentence snap (computed in pass 1; None = no meaningful change)
+      if snap is not None:
+          ns, ne = snap
+          snapped_emb, snapped_local_sim = next(snapped)
+          snapped_trope_sim = float(snapped_emb @ trope_vec) if trope_vec is not None else None
 
           # choose metric: prefer trope alignment; fall back to local if trope_vec missing
           base = trope_sim if trope_sim is not None else (local_sim or 0.0)
@@ -124,18 +235,22 @@ def main():
           if cand - base >= args.delta:
               print(f"[SUGGEST] {r['id']} {r['trope']} {r['s']}–{r['e']} -> {ns}–{ne}  (Δ={cand-base:.3f})")
               if args.apply:
-                  # history row
-                  DB.execute("""
-                    INSERT INTO trope_finding_human
-                      (id,finding_id,decision,corrected_start,corrected_end,corrected_trope_id,note,reviewer)
-                    VALUES (lower(hex(randomblob(16))), ?, 'edit', ?, ?, NULL, 'auto-snap', 'verifier')
-                  """, (r["id"], ns, ne))
-                  DB.execute("UPDATE trope_finding SET evidence_start=?, evidence_end=? WHERE id=?", (ns, ne, r["id"]))
-                  DB.commit()
+                  history_rows.append((r["id"], ns, ne))
+                  update_rows.append((ns, ne, r["id"]))
           else:
               print(f"[KEEP]    {r['id']} {r['trope']} {r['s']}–{r['e']} (no gain)")
       else:
           print(f"[OK]      {r['id']} {r['trope']} {r['s']}–{r['e']}")
 
+    if history_rows:
+        with DB:
+            # history rows
+            DB.executemany("""
+              INSERT INTO trope_finding_human
+                (id,finding_id,decision,corrected_start,corrected_end,corrected_trope_id,note,reviewer)
+              VALUES (lower(hex(randomblob(16))), ?, 'edit', ?, ?, NULL, 'auto-snap', 'verifier')
+            """, history_rows)
+            DB.executemany("UPDATE trope_finding SET evidence_start=?, evidence_end=? WHERE id=?", update_rows)
+
 if __name__ == "__main__":
     main()
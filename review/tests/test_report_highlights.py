@@ -0,0 +1,73 @@
+import random, sys
+from collections import Counter
+from html.parser import HTMLParser
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+from report_highlights import wrap_with_marks
+
+TEXT = "Hello <there> & \"friends\". This is a test! Another sentence?"
+
+class MarkParser(HTMLParser):
+    # checks nesting as it goes; records unescaped text, span ids and the
+    # number of open marks over every character
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack, self.text, self.depth, self.ids = [], [], [], []
+
+    def handle_starttag(self, tag, attrs):
+        assert tag == "mark", tag
+        attrs = dict(attrs)
+        if "data-span-id" in attrs:
+            self.ids.append(attrs["data-span-id"])
+        else:
+            assert attrs.get("class") == "cont", attrs
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        assert self.stack and self.stack[-1] == tag, f"unbalanced </{tag}>"
+        self.stack.pop()
+
+    def handle_data(self, data):
+        self.text.append(data)
+        self.depth.extend([len(self.stack)] * len(data))
+
+def check(text, spans):
+    p = MarkParser()
+    p.feed(wrap_with_marks(text, spans)); p.close()
+    assert not p.stack, "unclosed marks"
+    assert "".join(p.text) == text
+    kept = [sp for sp in spans if sp["e"] > sp["s"]]
+    assert Counter(p.ids) == Counter(sp["id"] for sp in kept)
+    # every character sits inside exactly as many marks as spans cover it
+    n = len(text)
+    cover = [sum(min(sp["s"], n) <= i < min(sp["e"], n) for sp in kept) for i in range(n)]
+    assert p.depth == cover
+
+def span(i, s, e, trope="T"):
+    return {"id": f"f{i}", "s": s, "e": e, "trope": trope}
+
+@pytest.mark.parametrize("spans", [
+    [],
+    [span(0, 0, 5)],
+    [span(0, 0, 10), span(1, 5, 15)],                   # overlapping
+    [span(0, 2, 20), span(1, 5, 10), span(2, 8, 30)],   # nested + straddling
+    [span(0, 3, 9), span(1, 3, 9), span(2, 3, 9)],      # identical
+    [span(0, 0, 5), span(1, 5, 10), span(2, 10, 12)],   # touching
+    [span(0, 0, 8), span(1, 0, 4), span(2, 4, 8)],      # shared start and end
+    [span(0, 40, 500), span(1, 55, 90), span(2, 200, 300)],  # past the end of the text
+    [span(0, 7, 7), span(1, 9, 4)],                     # empty and inverted: dropped
+    [span(0, 5, 25, "A&B"), span(1, 6, 12, '"quoted"')],     # escaped attributes
+])
+def test_wrap_with_marks_cases(spans):
+    check(TEXT, spans)
+
+def test_wrap_with_marks_random():
+    rng = random.Random(0)
+    for _ in range(300):
+        n = len(TEXT)
+        spans = [span(i, a, a + rng.randint(-2, 20), rng.choice("ABC"))
+                 for i, a in enumerate(rng.randint(0, n + 5) for _ in range(rng.randint(1, 8)))]
+        check(TEXT, spans)